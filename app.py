@@ -4,12 +4,51 @@
 import streamlit as st
 import pandas as pd
 import datetime
-from groq import Groq
+import queue
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from groq import Groq, GroqError
+import httpx
+import tiktoken
 import gspread
+import requests
 import json
 
 # --- NEW: Import the official Google Auth library ---
 from google.oauth2 import service_account
+from google.auth.exceptions import GoogleAuthError
+
+# --- SEARCH CONSTANTS ---
+STOP_WORDS = frozenset(['a', 'about', 'an', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'how', 'i', 'in', 'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'who', 'will', 'with', 'my', 'can', 'should', 'do', 'me', 'your'])
+
+# --- MODEL SETTINGS ---
+PROTOCOL_MODEL = "llama-3.1-8b-instant"
+# Flip to "llama-3.3-70b-specdec" if general answers need 70B quality.
+GENERAL_MODEL = "llama-3.1-8b-instant"
+# Patient answers rarely exceed 300 tokens; capping output bounds latency.
+MAX_RESPONSE_TOKENS = 384
+
+# Protocol context is clipped to this many tokens before prompting, so a
+# future top-k retriever or an unusually long Answer can't blow up TTFT.
+CONTEXT_TOKEN_BUDGET = 800
+
+# Oldest chat bubbles are dropped past this point, keeping per-session
+# memory and history re-renders bounded on the shared container.
+MAX_HISTORY_MESSAGES = 40
+
+# --- PROMPT TEMPLATES ---
+# Kept deliberately short: input-token count is the main TTFT driver, so the
+# rules live in a compact system message and each turn sends only
+# question + context.
+PROTOCOL_SYSTEM_RULES = "You are a friendly, reassuring assistant for the OrthoIndy spine surgery practice. Answer ONLY from the RELEVANT PROTOCOL INFO provided. Never use general medical knowledge."
+
+GENERAL_SYSTEM_RULES = "You are a friendly assistant with deep medical knowledge, answering a general medical question for a patient of the OrthoIndy spine surgery practice. Answer clearly and accurately."
+
+# Appended in Python after the completion — guaranteed verbatim, and the
+# model never spends output tokens regenerating it.
+GENERAL_DISCLAIMER = "---\n*Disclaimer: This is general medical information and not a substitute for direct medical advice regarding your specific condition. This information is not part of Dr. [Your Name]'s official protocol. For any questions about your personal care plan, please contact the OrthoIndy office directly.*"
 
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
@@ -19,16 +58,53 @@ st.set_page_config(
 )
 
 # --- AUTHENTICATION & CLIENT SETUP ---
+# Both clients are built lazily under @st.cache_resource. Failed attempts
+# are not cached, so a transient error at startup (DNS flake, secrets not
+# yet mounted) is retried on the next use instead of disabling the
+# subsystem for the life of the process. The exception tuples below are
+# deliberately narrow so genuine bugs surface instead of being swallowed.
+GROQ_SETUP_ERRORS = (KeyError, FileNotFoundError, GroqError)
+TRANSIENT_SHEETS_ERRORS = (gspread.exceptions.APIError, requests.exceptions.RequestException)
+SHEETS_SETUP_ERRORS = (KeyError, FileNotFoundError, ValueError, GoogleAuthError) + TRANSIENT_SHEETS_ERRORS
+
+def _retry_transient(operation, attempts=3, initial_delay=0.2, max_delay=5.0):
+    # Exponential backoff with jitter for transient network failures.
+    delay = initial_delay
+    for attempt in range(attempts):
+        try:
+            return operation()
+        except TRANSIENT_SHEETS_ERRORS:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(delay * (1 + random.random()))
+            delay = min(delay * 2, max_delay)
+
 # Initialize Groq client from Streamlit Secrets
+@st.cache_resource
+def get_groq_client():
+    # The Groq client is not serializable, so it lives in the resource cache
+    # and is shared across reruns and sessions. Keep-alive pooling on the
+    # underlying httpx client means requests reuse warm TCP+TLS connections
+    # instead of paying the handshake on every cold rerun.
+    return Groq(
+        api_key=st.secrets["GROQ_API_KEY"],
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20, keepalive_expiry=60.0),
+            timeout=30.0,
+        ),
+    )
+
 try:
-    client = Groq(api_key=st.secrets["GROQ_API_KEY"])
-    GROQ_API_AVAILABLE = True
-except Exception as e:
+    get_groq_client()
+except GROQ_SETUP_ERRORS:
     st.error("Groq API key is not configured correctly. Please check your app's Secrets settings.")
-    GROQ_API_AVAILABLE = False
 
 # Initialize Google Sheets client from Streamlit Secrets
-try:
+@st.cache_resource
+def get_log_sheet():
+    # Cached so the service-account handshake and sheet lookup happen once
+    # per process, not once per rerun. Opening the sheet here also warms up
+    # the metadata fetch so the first log write doesn't pay for it.
     # --- FIX: Use individual secret values instead of parsing JSON string ---
     creds_dict = {
         "type": st.secrets["gcp_service_account"]["type"],
@@ -42,7 +118,7 @@ try:
         "auth_provider_x509_cert_url": st.secrets["gcp_service_account"]["auth_provider_x509_cert_url"],
         "client_x509_cert_url": st.secrets["gcp_service_account"]["client_x509_cert_url"]
     }
-    
+
     # Create credentials using the official Google library
     credentials = service_account.Credentials.from_service_account_info(
         creds_dict,
@@ -51,23 +127,90 @@ try:
             'https://www.googleapis.com/auth/drive'
         ]
     )
-    
-    # Authorize gspread with the new credentials
+
+    # Authorize gspread with the new credentials and open the sheet by name
     gc = gspread.Client(auth=credentials)
+    return _retry_transient(lambda: gc.open("SDG_Chatbot_Log").sheet1)
 
-    # Open the Google Sheet by its name
-    log_sheet = gc.open("SDG_Chatbot_Log").sheet1
-    GSHEETS_AVAILABLE = True
-except Exception as e:
+try:
+    get_log_sheet()
+except SHEETS_SETUP_ERRORS as e:
     st.error(f"Google Sheets connection failed. Please check your app's Secrets settings and sheet name. Error: {e}")
-    GSHEETS_AVAILABLE = False
+
+# --- BACKGROUND LOG FLUSHING ---
+# Unanswered questions are buffered in a queue and written to the sheet in
+# batches by a daemon thread, so the chat never blocks on Sheets I/O.
+LOG_FLUSH_INTERVAL = 5.0
+LOG_FLUSH_MAX_ROWS = 50
+
+@st.cache_resource
+def get_log_queue():
+    # The queue must live in the resource cache: Streamlit re-executes this
+    # script in a fresh module namespace per rerun, so a module-level queue
+    # would be recreated constantly and the flusher thread would keep
+    # draining only the stale one it was started with.
+    return queue.Queue()
+
+def _log_flush_worker(sheet, log_queue):
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        batch = []
+        while len(batch) < LOG_FLUSH_MAX_ROWS:
+            try:
+                batch.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        if not batch: continue
+        try:
+            sheet.append_rows(batch, value_input_option='RAW')
+        except TRANSIENT_SHEETS_ERRORS:
+            # Put the rows back and retry on the next cycle.
+            for row in batch:
+                log_queue.put_nowait(row)
+
+@st.cache_resource
+def start_log_worker(_sheet):
+    # Cached so exactly one flusher thread exists across reruns/sessions.
+    # Started lazily by log_unanswered_question once the sheet is reachable.
+    worker = threading.Thread(target=_log_flush_worker, args=(_sheet, get_log_queue()), daemon=True)
+    worker.start()
+    return worker
 
 # --- DATA LOADING ---
-@st.cache_data
+def build_keyword_index(row_sets):
+    # Inverted index: keyword -> tuple of row ids containing it. Scoring a
+    # query then only touches the rows that share at least one keyword,
+    # instead of scanning every protocol row.
+    inverted = defaultdict(list)
+    for row_id, words in enumerate(row_sets):
+        for word in words:
+            inverted[word].append(row_id)
+    return {word: tuple(ids) for word, ids in inverted.items()}
+
+# persist="disk" keeps the parsed + preprocessed frame across container
+# restarts; frozensets in _search_set pickle fine.
+@st.cache_data(persist="disk", show_spinner=False)
 def load_data(csv_path):
     try:
         df = pd.read_csv(csv_path)
         df['Alternate_Questions'] = df['Alternate_Questions'].fillna('')
+        # Precompute the keyword set for each row once, so the scorer never
+        # has to lowercase/split/re-build sets per message.
+        df['_search_set'] = (df['Question'].str.lower() + ' ' + df['Alternate_Questions'].str.lower()).str.split().map(lambda words: frozenset(words) - STOP_WORDS)
+        # Compute the dropdown options once here instead of a .unique() scan
+        # on every rerun of the selection screen.
+        df.attrs['surgery_types'] = tuple(sorted(df['SurgeryType'].dropna().unique().tolist()))
+        # Per-surgery search structures, built once under the cache: the
+        # chat path only ever indexes into these plain tuples, never the
+        # DataFrame.
+        df.attrs['search_index'] = {
+            surgery: (
+                build_keyword_index(group['_search_set'].tolist()),
+                tuple(group['Question'].tolist()),
+                tuple(group['Answer'].tolist()),
+            )
+            for surgery, group in df.groupby('SurgeryType')
+        }
         return df
     except FileNotFoundError:
         st.error(f"The protocol file ('combined_protocols.csv') was not found in the GitHub repository.")
@@ -76,64 +219,155 @@ def load_data(csv_path):
 master_df = load_data("combined_protocols.csv")
 
 # --- CORE LOGIC FUNCTIONS ---
-def find_relevant_info(user_question, dataframe):
-    stop_words = set(['a', 'about', 'an', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'how', 'i', 'in', 'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'who', 'will', 'with', 'the', 'my', 'can', 'should', 'do', 'me', 'your'])
-    dataframe['Search_Text'] = dataframe['Question'] + ' ' + dataframe['Alternate_Questions']
-    query_words = set(user_question.lower().split()) - stop_words
+@st.cache_data(max_entries=256, ttl=1800, show_spinner=False)
+def _find_relevant_info_cached(normalized_question, surgery_type):
+    keyword_index, questions, answers = master_df.attrs['search_index'][surgery_type]
+    query_words = frozenset(normalized_question.split()) - STOP_WORDS
     num_keywords = len(query_words)
     if num_keywords == 0: return None
-    best_match_score = 0
-    best_match_index = -1
-    for index in range(len(dataframe)):
-        row = dataframe.iloc[index]
-        protocol_words = set(row['Search_Text'].lower().split()) - stop_words
-        common_words = query_words.intersection(protocol_words)
-        score = len(common_words)
-        if score > best_match_score:
-            best_match_score = score
-            best_match_index = index
+    row_counts = Counter()
+    for word in query_words:
+        row_counts.update(keyword_index.get(word, ()))
+    if not row_counts: return None
+    # Ties break toward the lowest row index, matching the original linear
+    # scan; most_common() would break them by insertion order, which varies
+    # with frozenset iteration order across processes.
+    best_match_index, best_match_score = min(row_counts.items(), key=lambda kv: (-kv[1], kv[0]))
     is_match = False
     if num_keywords <= 2 and best_match_score == num_keywords: is_match = True
     elif num_keywords > 2 and best_match_score >= 2: is_match = True
     if is_match:
-        relevant_row = dataframe.iloc[best_match_index]
-        context = f"--- RELEVANT PROTOCOL INFO ---\nQuestion: {relevant_row['Question']}\nAnswer: {relevant_row['Answer']}\n--- END OF PROTOCOL INFO ---\n"
+        context = f"--- RELEVANT PROTOCOL INFO ---\nQuestion: {questions[best_match_index]}\nAnswer: {answers[best_match_index]}\n--- END OF PROTOCOL INFO ---\n"
         return context
     else:
         return None
 
+def find_relevant_info(user_question, surgery_type):
+    # Normalize before the cached lookup so trivially different phrasings
+    # ("What should I bring?" vs "what should i bring") share an entry.
+    return _find_relevant_info_cached(user_question.lower().strip(), surgery_type)
+
+@st.cache_resource
+def get_token_encoder():
+    return tiktoken.get_encoding("cl100k_base")
+
+def trim_context(context):
+    token_ids = get_token_encoder().encode(context)
+    if len(token_ids) <= CONTEXT_TOKEN_BUDGET:
+        return context
+    return get_token_encoder().decode(token_ids[:CONTEXT_TOKEN_BUDGET]) + "\n[truncated]"
+
 def create_protocol_prompt(user_question, context):
-    return f"You are a helpful, polite, and safe AI assistant for the OrthoIndy spine surgery practice. Your role is to answer patient questions about their upcoming surgery. You must adhere to the following rules STRICTLY:\n1. Base your answer ONLY on the information provided in the 'RELEVANT PROTOCOL INFO' section.\n2. Do NOT use any of your general medical knowledge.\n3. Begin your answer in a friendly and reassuring tone.\n\nPATIENT QUESTION: \"{user_question}\"\n{context}\nPlease provide your answer now."
+    return [
+        {"role": "system", "content": PROTOCOL_SYSTEM_RULES},
+        {"role": "user", "content": f"Question: \"{user_question}\"\n{context}"},
+    ]
 
 def create_general_prompt(user_question):
-    return f"You are a helpful AI assistant with deep medical knowledge. A patient from the OrthoIndy spine surgery practice has asked a general medical question that is not covered by their surgeon's specific post-operative protocols. Your task is to answer the following question clearly and accurately for a patient.\nCRITICAL RULE: After providing your answer, you MUST include the following disclaimer verbatim (exactly as written) at the end of your response, separated by a line.\n---\n*Disclaimer: This is general medical information and not a substitute for direct medical advice regarding your specific condition. This information is not part of Dr. [Your Name]'s official protocol. For any questions about your personal care plan, please contact the OrthoIndy office directly.*\n\nPATIENT QUESTION: \"{user_question}\"\nPlease provide your answer now, followed by the mandatory disclaimer."
+    return [
+        {"role": "system", "content": GENERAL_SYSTEM_RULES},
+        {"role": "user", "content": f"Question: \"{user_question}\""},
+    ]
 
 def log_unanswered_question(user_question, surgery_type):
-    if not GSHEETS_AVAILABLE: return
+    # Non-blocking: the row is flushed to Sheets by the background worker
+    # while the Groq call is in flight.
     try:
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_sheet.append_row([timestamp, surgery_type, user_question])
-        st.info("This question has been logged for review.", icon="📝")
-    except Exception as e:
-        st.warning(f"Could not write to the log file. Error: {e}")
-
-def get_model_response(prompt_text):
-    if not GROQ_API_AVAILABLE: return "The AI model is currently unavailable."
+        start_log_worker(get_log_sheet())
+    except SHEETS_SETUP_ERRORS:
+        return
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    get_log_queue().put_nowait([timestamp, surgery_type, user_question])
+
+def _stream_groq(messages, model):
+    stream = get_groq_client().chat.completions.create(
+        messages=messages,
+        model=model,
+        temperature=0,
+        max_tokens=MAX_RESPONSE_TOKENS,
+        stream=True,
+    )
+    for chunk in stream:
+        yield chunk.choices[0].delta.content or ""
+
+@st.cache_resource
+def get_response_cache():
+    # Plain dict shared across reruns and sessions. A dict (rather than
+    # @st.cache_data) lets us check for a hit up front: hits render
+    # instantly as a string, misses stream token by token.
+    return {}
+
+def _cache_key(messages, model):
+    return (tuple((m["role"], m["content"]) for m in messages), model)
+
+def remember_response(messages, model, response):
+    cache = get_response_cache()
+    if len(cache) >= 512:
+        cache.pop(next(iter(cache)))
+    cache[_cache_key(messages, model)] = response
+
+def get_model_response(messages, model, use_cache=False):
+    """Return a cached response string, or a chunk generator for st.write_stream."""
     try:
-        chat_completion = client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt_text}],
-            model="llama3-8b-8192",
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        return f"An error occurred while contacting the AI model: {e}"
+        get_groq_client()
+    except GROQ_SETUP_ERRORS:
+        return "The AI model is currently unavailable."
+    if use_cache:
+        cached = get_response_cache().get(_cache_key(messages, model))
+        if cached is not None: return cached
+    return _stream_groq(messages, model)
 
 # --- STREAMLIT UI ---
 
+@st.fragment
+def chat_panel():
+    # Runs as a fragment: a new chat message reruns only this block, not
+    # the page config, client bootstrap, or sidebar above it.
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+    if prompt := st.chat_input("Ask a question about your surgery..."):
+        st.session_state.messages.append({"role": "user", "content": prompt})
+        with st.chat_message("user"):
+            st.markdown(prompt)
+
+        with st.chat_message("assistant"):
+            with st.spinner("Thinking..."):
+                protocol_context = find_relevant_info(prompt, st.session_state.surgery_type)
+
+                if protocol_context:
+                    final_messages = create_protocol_prompt(prompt, trim_context(protocol_context))
+                    model = PROTOCOL_MODEL
+                else:
+                    log_unanswered_question(prompt, st.session_state.surgery_type)
+                    final_messages = create_general_prompt(prompt)
+                    model = GENERAL_MODEL
+
+            # Only protocol answers are cached: prompt + context is fully
+            # deterministic there, while general medical answers stay fresh.
+            response = get_model_response(final_messages, model, use_cache=protocol_context is not None)
+            if isinstance(response, str):
+                st.markdown(response)
+            else:
+                try:
+                    response = st.write_stream(response)
+                except Exception as e:
+                    response = f"An error occurred while contacting the AI model: {e}"
+                    st.markdown(response)
+                else:
+                    if protocol_context:
+                        remember_response(final_messages, model, response)
+                    else:
+                        st.markdown(GENERAL_DISCLAIMER)
+                        response = f"{response}\n\n{GENERAL_DISCLAIMER}"
+
+        st.session_state.messages.append({"role": "assistant", "content": response})
+
 st.title("SDG Spine Surgery Patient Assistant")
 
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_HISTORY_MESSAGES)
 if "surgery_type" not in st.session_state:
     st.session_state.surgery_type = None
 
@@ -141,12 +375,13 @@ if st.session_state.surgery_type is None:
     st.info("Welcome! To provide the most accurate information, please select your surgery type below.")
     
     if master_df is not None:
-        surgery_options = list(master_df['SurgeryType'].unique())
-        selected_surgery = st.selectbox("Select your surgery:", [""] + surgery_options)
+        surgery_options = master_df.attrs['surgery_types']
+        selected_surgery = st.selectbox("Select your surgery:", ("",) + surgery_options)
 
         if selected_surgery:
+            # The per-surgery search structures were prebuilt in load_data;
+            # find_relevant_info looks them up by surgery type.
             st.session_state.surgery_type = selected_surgery
-            st.session_state.session_df = master_df[master_df['SurgeryType'] == selected_surgery].copy().reset_index(drop=True)
             st.rerun()
     else:
         st.error("Protocol data could not be loaded. The app cannot continue.")
@@ -155,32 +390,9 @@ else:
     st.sidebar.title("Options")
     if st.sidebar.button("Change Surgery / Start Over"):
         st.session_state.surgery_type = None
-        st.session_state.messages = []
+        st.session_state.messages = deque(maxlen=MAX_HISTORY_MESSAGES)
         st.rerun()
 
     st.success(f"Protocol for **{st.session_state.surgery_type.upper()}** is loaded. How can I help you?")
 
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-
-    if prompt := st.chat_input("Ask a question about your surgery..."):
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-
-        with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                protocol_context = find_relevant_info(prompt, st.session_state.session_df)
-                
-                final_prompt = ""
-                if protocol_context:
-                    final_prompt = create_protocol_prompt(prompt, protocol_context)
-                else:
-                    log_unanswered_question(prompt, st.session_state.surgery_type)
-                    final_prompt = create_general_prompt(prompt)
-                
-                response = get_model_response(final_prompt)
-                st.markdown(response)
-        
-        st.session_state.messages.append({"role": "assistant", "content": response})
+    chat_panel()